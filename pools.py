@@ -27,17 +27,19 @@ or resuming it.
 There are also asynchronous pools and population pools.
 """
 import abc
-from asyncio import Condition as ACondition
+from asyncio import ensure_future
+from asyncio import Condition as ACondition, Event as AEvent
+from asyncio import LifoQueue as ALifoQueue
 from collections import deque
 import collections.abc as collabc
-import itertools
 from typing import AbstractSet, AsyncGenerator, AsyncIterator
-from typing import Generator, Optional, Set, TypeVar
+from typing import Generator, Iterable, Optional, TypeVar
 try:
-    from threading import Condition
+    from threading import Lock, Semaphore
 except ImportError:
-    from dummy_threading import Condition
+    from dummy_threading import Lock, Semaphore
 import sys
+import weakref
 if sys.version_info >= (3, 8):
     from typing import Protocol as Proto
 else:
@@ -57,6 +59,22 @@ T = TypeVar('T')
 OpT = Optional[T]
 R_co = TypeVar('R_co', covariant=True)
 H = TypeVar('H', bound=collabc.Hashable)
+#Marks an empty slot where None would be ambiguous:
+_MISSING = object()
+#Before 3.10, asyncio primitives bind to the current event loop
+#when created, so they can't be made until the pool is in use:
+_EAGER_ASYNC = sys.version_info >= (3, 10)
+
+def _thrown(typ, val=None, tb=None) -> BaseException:
+    """Builds the exception that the generator protocol's throw()
+    would raise, without raising it."""
+    if val is None:
+        val = typ() if isinstance(typ, type) else typ
+    elif not isinstance(val, BaseException):
+        val = typ(*val) if isinstance(val, tuple) else typ(val)
+    if tb is not None:
+        val = val.with_traceback(tb)
+    return val
 
 class Pool(Generator[OpT, OpT, R_co], Proto[T, R_co]):
     """A pool of objects that can be returned for reuse."""
@@ -85,192 +103,403 @@ class AsyncPopulationPool(AsyncPool[T], Proto[T]):
         more values."""
         pass
 
-class SimpleIntPool(collabc.Generator, Pool[int, None]):
+class SimpleIntPool(Pool[int, None]):
     """A simple source of integers."""
     def __init__(self):
-        self._src = itertools.count()
         #The lowest int that has never been yielded:
-        self._top = next(self._src)
-        #The queue of returned values:
-        self._rvq = deque()
+        self._top = 0
+        #The most recently returned value, if any:
+        self._head = _MISSING
+        #The stack of older returned values (most recent last):
+        self._rvq = []
+        #All returned values, for fast membership tests:
+        self._rvq_set = set()
         self._stopped = False
 
-    def send(self, value):
+    def send(self, value=None):
         """Request an int, or return one."""
         if self._stopped: raise StopIteration
-        if not isinstance(value, int):
-            if len(self._rvq) > 0:
-                try:
-                    return self._rvq.popleft()
-                except IndexError:
-                    yv, self._top = self._top, next(self._src)
-                    return yv
-            yv, self._top = self._top, next(self._src)
+        if value is None:
+            yv = self._head
+            if yv is not _MISSING:
+                self._head = _MISSING
+            elif self._rvq:
+                yv = self._rvq.pop()
+            else:
+                yv = self._top
+                self._top = yv + 1
+                return yv
+            self._rvq_set.discard(yv)
             return yv
-        else:
-            if 0 <= value < self._top and value not in self._rvq:
-                self._rvq.push(value)
-            #Otherwise, silently swallow it.
+        elif (type(value) is int and 0 <= value < self._top
+              and value not in self._rvq_set):
+            if self._head is not _MISSING:
+                self._rvq.append(self._head)
+            self._head = value
+            self._rvq_set.add(value)
+        #Otherwise, silently swallow it.
+
+    __next__ = send
 
     def throw(self, typ, val=None, tb=None):
-        """Stop iterating and close the pool with an exception."""
-        try:
-            return super().throw(typ, val, tb)
-        except (Exception, GeneratorExit) as exc:
-            self._stopped = True
-            raise StopIteration from exc
+        """Stop iterating and close the pool with an exception.
+
+        >>> p = SimpleIntPool()
+        >>> try:
+        ...     p.throw(ValueError, "msg")
+        ... except StopIteration as exc:
+        ...     print(repr(exc.__cause__))
+        ValueError('msg')
+        >>> next(p)
+        Traceback (most recent call last):
+          ...
+        StopIteration
+        """
+        exc = _thrown(typ, val, tb)
+        if not isinstance(exc, (Exception, GeneratorExit)): raise exc
+        self._stopped = True
+        raise StopIteration from exc
+
+    def close(self):
+        """Stop iterating and close the pool."""
+        self._stopped = True
 
-class SetBasedPopulationPool(collabc.Generator,
-                             PopulationPool[H, None]):
-    """A population pool backed by a set."""
+class SetBasedPopulationPool(PopulationPool[H, None]):
+    """A population pool of distinct values, kept as the keys of
+    an insertion-ordered dict.
+
+    The most recently added value is the first handed out; the
+    initial values, taken from a set, come out in arbitrary order."""
     def __init__(self,
                  ivals: Optional[AbstractSet[H]] = None
                  ) -> None:
-        if ivals is None:
-            self._set = Set[H]()
-        else:
-            self._set = {ivals}
-        self._con = Condition()
+        #Keys only; a dict keeps them in the order they were added:
+        self._vals = {} if ivals is None else dict.fromkeys(ivals)
+        #Guards self._vals; never held while blocking:
+        self._lock = Lock()
+        #Counts the values in self._vals:
+        self._sem = Semaphore(len(self._vals))
         self._stopped = False
 
     def populate(self, val: H, *args: H) -> None:
+        self.populate_many((val,) + args)
+
+    def populate_many(self, items: Iterable[H]) -> None:
+        """Populates this pool with every value in an iterable.
+
+        Collections are read in place; other iterables are copied
+        first, so that they aren't run while the pool is locked."""
         #Can't populate a closed pool:
         if self._stopped: raise StopIteration
-        if args is None or len(args) == 0:
-            self._set.add(val)
-            count = 1
-        else:
-            argset = {args}
-            count = 1 + len(argset)
-            self._set.add(val)
-            self._set |= argset
-        with self._con as c:
-            c.notify(count)
-
-    def send(self, value: Optional[H]) -> Optional[H]:
+        if not isinstance(items, collabc.Collection):
+            items = list(items)
+        vals = self._vals
+        added = 0
+        try:
+            with self._lock:
+                count = len(vals)
+                try:
+                    for v in items:
+                        vals[v] = None
+                finally:
+                    added = len(vals) - count
+        finally:
+            #Release a permit for whatever was added, even if a value
+            #turned out to be unhashable:
+            for _ in range(added):
+                self._sem.release()
+
+    def send(self, value: Optional[H] = None) -> Optional[H]:
         """Request an object from the pool, or supply one."""
         if self._stopped: raise StopIteration
         if value is None:
-            with self._con as c:
-                while len(self._set) == 0:
-                    c.wait()
-                    if self._stopped: raise StopIteration
-                return self._set.pop()
+            self._sem.acquire()
+            if self._stopped:
+                #Pass the wakeup on to the next blocked consumer:
+                self._sem.release()
+                raise StopIteration
+            with self._lock:
+                return self._vals.popitem()[0]
         else:
-            if value not in self._set:
-                self._set.add(value)
-                with self._con as c:
-                    c.notify()
+            with self._lock:
+                if value in self._vals: return
+                self._vals[value] = None
+            self._sem.release()
+
+    __next__ = send
 
     def throw(self, typ, val=None, tb=None):
         """Stop iterating and close the pool with an exception."""
-        try:
-            return super().throw(typ, val, tb)
-        except (Exception, GeneratorExit) as exc:
-            self._stopped = True
-            with self._con as c:
-                c.notify_all()
-            raise StopIteration from exc
+        exc = _thrown(typ, val, tb)
+        if not isinstance(exc, (Exception, GeneratorExit)): raise exc
+        self._stopped = True
+        #Blocked consumers wake each other in turn:
+        self._sem.release()
+        raise StopIteration from exc
+
+class SetBasedAsyncPopPool(AsyncPopulationPool[H]):
+    """An asynchronous population pool of distinct values, held
+    in an asyncio LIFO queue alongside a set that filters out
+    duplicates.
 
-class SetBasedAsyncPopPool(collabc.AsyncGenerator,
-                           AsyncPopulationPool[H]):
-    """An asynchronous population pool backed by a set."""
+    The most recently added value is the first handed out; the
+    initial values, taken from a set, come out in arbitrary order."""
     def __init__(self, ivals: Optional[AbstractSet[H]] = None):
+        #The values currently in the pool, also held in self._q:
+        self._queued = set() if ivals is None else set(ivals)
+        self._q = self._new_queue() if _EAGER_ASYNC else None
         self._stopped = False
-        self._set = Set[H]() if ivals is None else {ivals}
-        self._ac = None
-        self._stopped = False
+
+    def _new_queue(self) -> ALifoQueue:
+        q = ALifoQueue()
+        for v in self._queued:
+            q.put_nowait(v)
+        return q
 
     async def apopulate(self, val: H, *args: H) -> None:
         #Can't populate a closed pool:
         if self._stopped: raise StopAsyncIteration
-        if self._ac is None: self._ac = ACondition()
-        if args is None or len(args) == 0:
-            self._set.add(val)
-            count = 1
-        else:
-            argset = {args}
-            argset.add(val)
-            count = len(argset)
-            self._set |= argset
-        async with self._ac:
-            self._ac.notify(count)
-
-    async def asend(self, value: Optional[H]) -> Optional[H]:
+        if self._q is None: self._q = self._new_queue()
+        for v in (val,) + args:
+            if v not in self._queued:
+                self._queued.add(v)
+                self._q.put_nowait(v)
+
+    async def asend(self, value: Optional[H] = None
+                    ) -> Optional[H]:
         if self._stopped: raise StopAsyncIteration
-        if self._ac is None: self._ac = ACondition()
+        if self._q is None: self._q = self._new_queue()
         if value is None:
-            async with self._ac:
-                while len(self._set) == 0:
-                    self._ac.wait()
-                    if self._stopped: raise StopAsyncIteration
-                return self._set.pop()
+            yv = await self._q.get()
+            if yv is _MISSING:
+                #Pass the wakeup on to the next blocked consumer:
+                self._q.put_nowait(yv)
+                raise StopAsyncIteration
+            self._queued.discard(yv)
+            return yv
         else:
-            if value not in self._set:
-                self._set.add(value)
-                await self._ac.acquire()
-                self._ac.notify()
-                self._ac.release()
+            if value not in self._queued:
+                self._queued.add(value)
+                self._q.put_nowait(value)
+
+    __anext__ = asend
 
     async def athrow(self, typ, val=None, tb=None) -> None:
-        try:
-            return await super().athrow(typ, val, tb)
-        except (Exception, GeneratorExit) as exc:
-            self._stopped = True
-            if self._ac is not None:
-                await self._ac.acquire()
-                self._ac.notify_all()
-                self._ac.release()
-            raise StopAsyncIteration from exc
+        exc = _thrown(typ, val, tb)
+        if not isinstance(exc, (Exception, GeneratorExit)): raise exc
+        self._stopped = True
+        if self._q is not None:
+            #Blocked consumers wake each other in turn:
+            self._q.put_nowait(_MISSING)
+        raise StopAsyncIteration from exc
 
-class AsyncIteratorPool(collabc.AsyncGenerator,
-                         AsyncPool[T]):
-    """An asynchronous pool that wraps another async iterator."""
-    def __init__(self, base: AsyncIterator[T]):
+class AsyncIteratorPool(AsyncPool[T]):
+    """An asynchronous pool that wraps another async iterator.
+
+    If *prefetch* is greater than 1, a background task keeps up
+    to that many values fetched from *base* ahead of demand. It
+    runs until the pool is closed with ``aclose()`` or garbage
+    collected; close the pool before its event loop closes."""
+    def __init__(self, base: AsyncIterator[T], prefetch: int = 1):
+        if prefetch < 1:
+            raise ValueError("prefetch must be at least 1")
         self._base = base
         self._basegen = isinstance(base, collabc.AsyncGenerator)
-        self._yl = deque()
+        #Outstanding yielded values; unhashable ones are keyed
+        #by id() in self._yids:
+        self._yl = set()
+        self._yids = {}
         self._rl = deque()
-        self._ac = None
+        self._ac = ACondition() if _EAGER_ASYNC else None
+        #Whether a task is awaiting the base iterator:
+        self._fetching = False
+        self._prefetch = prefetch
+        #The prefetching task, an event it waits on for room, and
+        #the exception that ended it, if any:
+        self._pump = None
+        self._room = None
+        self._pump_exc = None
         self._stopped = False
 
-    async def asend(self, value: OpT) -> OpT:
+    async def asend(self, value: OpT = None) -> OpT:
+        """Request a value, or return one.
+
+        A waiting consumer that is cancelled doesn't strand the
+        others:
+
+        >>> import asyncio
+        >>> async def main():
+        ...     ev = asyncio.Event()
+        ...     async def gen():
+        ...         i = 0
+        ...         while True:
+        ...             await ev.wait()
+        ...             yield i
+        ...             i += 1
+        ...     p = AsyncIteratorPool(gen())
+        ...     a, b, c = [ensure_future(p.asend()) for _ in range(3)]
+        ...     await asyncio.sleep(0)
+        ...     ev.set()
+        ...     #Cancel b just after a hands its wakeup to b:
+        ...     asyncio.get_event_loop().call_soon(b.cancel)
+        ...     print(await a)
+        ...     print(await asyncio.wait_for(c, 1))
+        ...     await p.aclose()
+        >>> asyncio.new_event_loop().run_until_complete(main())
+        0
+        1
+        """
         if self._stopped: raise StopAsyncIteration
         if self._ac is None: self._ac = ACondition()
+        if self._room is None and self._prefetch > 1:
+            self._room = AEvent()
+            self._start_pump()
         if value is None:
             async with self._ac:
-                if len(self._rl) == 0:
+                #Only one task pulls from the base at a time:
+                while len(self._rl) == 0 and (self._fetching or
+                                              self._pump is not None):
                     try:
-                        if self._basegen:
-                            yv = await self._base.asend(None)
-                        else:
-                            yv = await self._base.__anext__()
-                        self._yl.append(yv)
-                        return yv
-                    except (Exception, GeneratorExit) as exc:
-                        self._stopped = True
-                        self._ac.notify_all()
-                        raise StopAsyncIteration from exc
-                else:
+                        await self._ac.wait()
+                    except BaseException:
+                        #Pass on any wakeup this task was given but
+                        #can't act on, e.g. when it's cancelled:
+                        self._ac.notify()
+                        raise
+                    if self._stopped: raise StopAsyncIteration
+                if len(self._rl) > 0:
                     yv = self._rl.popleft()
-                    self._yl.append(yv)
+                    self._add_yielded(yv)
+                    if self._room is not None: self._room.set()
                     return yv
+                if self._pump_exc is not None:
+                    #Don't call the base again after it failed:
+                    self._stopped = True
+                    self._ac.notify_all()
+                    raise StopAsyncIteration from self._pump_exc
+                self._fetching = True
+            #Don't hold the lock while awaiting the base, so values
+            #can still be returned meanwhile:
+            yv = _MISSING
+            try:
+                yv = await self._fetch()
+            except (Exception, GeneratorExit) as exc:
+                self._stopped = True
+                raise StopAsyncIteration from exc
+            finally:
+                async with self._ac:
+                    self._fetching = False
+                    if yv is not _MISSING: self._add_yielded(yv)
+                    if self._stopped:
+                        self._ac.notify_all()
+                    else:
+                        self._ac.notify()
+            return yv
         else:
             async with self._ac:
-                if value in self._yl:
-                    self._yl.remove(value)
+                if self._remove_yielded(value):
                     self._rl.append(value)
+                    self._ac.notify()
+
+    __anext__ = asend
+
+    async def _fetch(self) -> T:
+        if self._basegen:
+            return await self._base.asend(None)
+        else:
+            return await self._base.__anext__()
+
+    def _start_pump(self) -> None:
+        room = self._room
+        #The pump only holds the pool weakly, so that a pool that's
+        #dropped unclosed can still be collected; wake the pump
+        #when that happens so it can finish:
+        ref = weakref.ref(self, lambda _: room.set())
+        self._pump = ensure_future(self._prefetch_values(ref))
+
+    @staticmethod
+    async def _prefetch_values(ref: 'weakref.ref[AsyncIteratorPool]'
+                               ) -> None:
+        """Keeps up to the pool's prefetch count of unclaimed values
+        on hand, until the pool is stopped or collected."""
+        pool = ref()
+        if pool is None: return
+        base, basegen, room = pool._base, pool._basegen, pool._room
+        while not pool._stopped and pool._pump is not None:
+            if len(pool._rl) >= pool._prefetch:
+                room.clear()
+                del pool
+                await room.wait()
+            else:
+                del pool
+                try:
+                    if basegen:
+                        yv = await base.asend(None)
+                    else:
+                        yv = await base.__anext__()
+                except (Exception, GeneratorExit) as exc:
+                    #Leave the values already fetched to be claimed;
+                    #asend() stops the pool once they're gone.
+                    pool = ref()
+                    if pool is None: return
+                    pool._pump_exc = exc
+                    pool._pump = None
+                    async with pool._ac:
+                        pool._ac.notify_all()
+                    return
+                pool = ref()
+                if pool is None: return
+                async with pool._ac:
+                    pool._rl.append(yv)
+                    pool._ac.notify()
+                del pool
+            pool = ref()
+            if pool is None: return
+
+    def _add_yielded(self, yv: T) -> None:
+        try:
+            self._yl.add(yv)
+        except TypeError:
+            self._yids[id(yv)] = yv
+
+    def _remove_yielded(self, value: T) -> bool:
+        """Forgets an outstanding value; returns whether it was."""
+        try:
+            if value in self._yl:
+                self._yl.remove(value)
+                return True
+            return False
+        except TypeError:
+            if self._yids.get(id(value)) is value:
+                del self._yids[id(value)]
+                return True
+            return False
 
     async def athrow(self, typ, val=None, tb=None):
+        pump, self._pump = self._pump, None
+        if pump is not None:
+            #The base can't be thrown into while the pump awaits
+            #it; let the pump finish its fetch rather than cancel
+            #it, which would throw CancelledError into the base.
+            self._room.set()
+            await pump
         try:
             if self._basegen:
-                return await self._base.athrow(typ, val, tb)
+                try:
+                    return await self._base.athrow(typ, val, tb)
+                except (Exception, GeneratorExit) as e:
+                    exc = e
             else:
-                return await super().athrow(typ, val, tb)
-        except (Exception, GeneratorExit) as exc:
+                exc = _thrown(typ, val, tb)
+                if not isinstance(exc, (Exception, GeneratorExit)):
+                    raise exc
             self._stopped = True
             if self._ac is not None:
-                await self._ac.acquire()
-                self._ac.notify_all()
-                self._ac.release()
+                async with self._ac:
+                    self._ac.notify_all()
             raise StopAsyncIteration from exc
+        finally:
+            #Resume prefetching unless the pool is done:
+            if (pump is not None and not self._stopped
+                    and self._pump_exc is None):
+                self._start_pump()